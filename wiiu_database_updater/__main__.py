@@ -1,6 +1,7 @@
 import logging
 import argparse
 from pathlib import Path
+from typing import Callable, TypeVar
 
 from nus_tools.config import Configuration as NUSToolsConfiguration
 from nus_tools.structs import rootkey
@@ -10,10 +11,31 @@ from reqcli.source import SourceConfig
 
 from .database import Database
 from .eshop import EShop
+from .cache import RequestStats
+from .verify import TMDVerifier
+from .pool import ConnectionPool
 
 
+T = TypeVar('T')
+
 latest_update_list_version_name = 'latest_update_list_version'
 
+_logger = logging.getLogger('wiiu_database_updater')
+
+
+def positive(type: Callable[[str], T]) -> Callable[[str], T]:
+    '''
+    Wraps an argument type, rejecting values <= 0
+    '''
+
+    def convert(value: str) -> T:
+        result = type(value)
+        if result <= 0:  # type: ignore
+            raise argparse.ArgumentTypeError(f'must be greater than 0: {value}')
+        return result
+    convert.__name__ = type.__name__  # used by argparse in error messages
+    return convert
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -36,6 +58,12 @@ def parse_args() -> argparse.Namespace:
         default=None,
         help='path to \'Root\' public key (signing CA for TMD/Ticket files)'
     )
+    parser.add_argument(
+        '--verify-processes',
+        type=positive(int),
+        default=None,
+        help='number of processes used for verifying TMD signatures (defaults to number of CPUs)'
+    )
     parser.add_argument(
         '--cache-file',
         default=ReqCliConfiguration.cache_name,
@@ -70,6 +98,18 @@ def parse_args() -> argparse.Namespace:
         default=2,
         help='maximum requests per host per second'
     )
+    parser.add_argument(
+        '--pool-connections',
+        type=positive(int),
+        default=10,
+        help='number of hosts to keep connection pools for'
+    )
+    parser.add_argument(
+        '--pool-maxsize',
+        type=positive(int),
+        default=10,
+        help='maximum number of keep-alive connections per host'
+    )
     for name in ('titles', 'updates', 'dlcs'):
         parser.add_argument(
             f'--no-{name}',
@@ -79,6 +119,19 @@ def parse_args() -> argparse.Namespace:
             help=f'don\'t retrieve new {name}'
         )
 
+    parser.add_argument(
+        '--dlc-time-budget',
+        type=positive(float),
+        default=None,
+        help='maximum number of seconds to spend checking for dlcs (most promising titles are checked first)'
+    )
+    parser.add_argument(
+        '--dlc-max-titles',
+        type=positive(int),
+        default=None,
+        help='maximum number of titles to check for dlcs (most promising titles are checked first)'
+    )
+
     parser.add_argument(
         'client_cert',
         help='path to file containing client certificate and key (common prod)'
@@ -127,10 +180,6 @@ def main() -> None:
     for name in ('reqcli', 'nus_tools'):
         logging.getLogger(name).setLevel(getattr(logging, args.log_level_dep.upper()))
 
-    # load root publickey for verifying signatures
-    if args.root_key_file:
-        NUSToolsConfiguration.root_key_struct = rootkey.parse_file(args.root_key_file)
-
     # set cache path
     ReqCliConfiguration.cache_name = args.cache_file
 
@@ -147,11 +196,29 @@ def main() -> None:
     db = Database(str(args.input_dir))
     db.read_all()
 
+    source_config = SourceConfig(requests_per_second=args.requests_per_second)
+
+    # verify signatures in separate processes using root publickey;
+    # the key is parsed here to fail early if it's invalid
+    verifier = None
+    if args.root_key_file:
+        root_key = rootkey.parse_file(args.root_key_file)
+        verifier = TMDVerifier(root_key, args.verify_processes)
+
+    # share connections between all sources
+    pool = ConnectionPool(args.pool_connections, args.pool_maxsize)
+
+    # track cache hits/misses, see `python -m wiiu_database_updater.cache stats`
+    request_stats = RequestStats(args.cache_file)
+
     eshop = EShop(
         db,
         args.client_cert,
         not args.no_reload,
-        SourceConfig(requests_per_second=args.requests_per_second)
+        source_config,
+        request_stats,
+        verifier,
+        pool
     )
 
     if args.get_titles:
@@ -165,7 +232,7 @@ def main() -> None:
 
     if args.get_dlcs:
         # load dlcs
-        eshop.get_wiiu_dlcs()
+        eshop.get_wiiu_dlcs(args.dlc_time_budget, args.dlc_max_titles)
 
     # fix/merge regions, write new files
     db.fixup_regions()
@@ -174,5 +241,17 @@ def main() -> None:
     # write new updatelist version
     write_update_list_version(args.output_dir, latest_update_list_version)
 
+    _logger.info(pool.report())
+    pool.close()
+
+    # store cache hits/misses of this run
+    request_stats.write()
+
+    if verifier is not None:
+        verifier.shutdown()
+        _logger.info(verifier.report())
+
 
-main()
+# guarded, since worker processes (see `TMDVerifier`) may re-import this module
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+import re
+import json
+import logging
+import argparse
+import collections
+from enum import Enum, auto
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests_cache.backends.sqlite import SQLiteCache
+from reqcli.config import Configuration as ReqCliConfiguration
+
+from .pool import get_source_session
+
+
+_logger = logging.getLogger(__name__)
+
+_updatelist_version_re = re.compile(r'/list/(\d+)\.versionlist$')
+
+
+class SourceType(Enum):
+    '''
+    Type of source a cached response originated from, determined by the response's host
+    '''
+
+    SAMURAI = auto()
+    NINJA = auto()
+    IDBE = auto()
+    TAGAYA = auto()
+    CCS = auto()
+    OTHER = auto()
+
+    @staticmethod
+    def from_host(host: str) -> 'SourceType':
+        # e.g. samurai.wup.shop.nintendo.net, idbe-wup.cdn.nintendo.net, ccs.cdn.wup.shop.nintendo.net
+        prefix = re.split(r'[.-]', host, 1)[0]
+        try:
+            return SourceType[prefix.upper()]
+        except KeyError:
+            return SourceType.OTHER
+
+
+@dataclass
+class CacheEntry:
+    '''
+    Metadata of a single cached response
+    '''
+
+    key: str
+    url: str
+    created_at: Optional[datetime]
+    size: int
+    # sqlite rowid of the response, changes whenever the response is (re-)written
+    rowid: int
+
+    @property
+    def host(self) -> str:
+        return urlparse(self.url).hostname or ''
+
+    @property
+    def source_type(self) -> SourceType:
+        return SourceType.from_host(self.host)
+
+
+class CacheIndex:
+    '''
+    Metadata of cached responses, persisted in a .json file next to the cache, so that
+    maintenance only has to deserialize responses that were added/refreshed since the last time
+    '''
+
+    def __init__(self, cache_name: str):
+        self.path = Path(f'{cache_name}.index.json')
+        self._entries: Dict[str, CacheEntry] = {}
+        if self.path.exists():
+            for key, values in json.loads(self.path.read_text()).items():
+                if len(values) != 4:
+                    continue  # written by an older version, re-read
+                url, created_at, size, rowid = values
+                self._entries[key] = CacheEntry(key, url, datetime.fromisoformat(created_at) if created_at else None, size, rowid)
+
+    def get(self, key: str, rowid: int) -> Optional[CacheEntry]:
+        '''
+        Returns the entry for the specified key, if it exists and
+        the response wasn't rewritten since the entry was added
+        '''
+
+        entry = self._entries.get(key)
+        if entry is None or entry.rowid != rowid:
+            return None
+        return entry
+
+    def add(self, entry: CacheEntry) -> None:
+        self._entries[entry.key] = entry
+
+    def remove(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def retain(self, keys: Set[str]) -> None:
+        '''
+        Removes all entries except for the specified keys
+        '''
+
+        self.remove([k for k in self._entries if k not in keys])
+
+    def write(self) -> None:
+        self.path.write_text(json.dumps({
+            e.key: [e.url, e.created_at.isoformat() if e.created_at else None, e.size, e.rowid]
+            for e in self._entries.values()
+        }))
+
+
+class RequestStats:
+    '''
+    Keeps track of cache hits/misses per host, persisted in a .json file next to the cache
+    '''
+
+    def __init__(self, cache_name: str):
+        self.path = Path(f'{cache_name}.stats.json')
+        self._counts: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+
+    def install(self, source: Any) -> None:
+        '''
+        Starts recording hits/misses of the specified source's requests
+        '''
+
+        session = get_source_session(source)
+        if session is None:
+            _logger.warning(f'unable to track cache hits/misses of {type(source).__name__}, no session found')
+            return
+
+        send = session.send
+
+        def send_and_record(request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+            response = send(request, **kwargs)
+            self.record(response)
+            return response
+        session.send = send_and_record  # type: ignore
+
+    def record(self, response: requests.Response) -> None:
+        host = urlparse(response.url).hostname or ''
+        self._counts[host]['hits' if getattr(response, 'from_cache', False) else 'misses'] += 1
+
+    def read(self) -> Dict[str, Dict[str, int]]:
+        '''
+        Returns the persisted counts, merged with the counts recorded so far
+        '''
+
+        merged: Dict[str, Dict[str, int]] = collections.defaultdict(lambda: {'hits': 0, 'misses': 0})
+        if self.path.exists():
+            for host, counts in json.loads(self.path.read_text()).items():
+                merged[host].update(counts)
+        for host, counts in self._counts.items():
+            for name, value in counts.items():
+                merged[host][name] += value
+        return dict(merged)
+
+    def write(self) -> None:
+        '''
+        Adds the counts recorded so far to the persisted counts
+        '''
+
+        self.path.write_text(json.dumps(self.read(), indent=2))
+        self._counts.clear()
+
+    def clear(self) -> None:
+        self._counts.clear()
+        if self.path.exists():
+            self.path.unlink()
+
+
+class CacheMaintainer:
+    '''
+    Provides stats and eviction/compaction of the request cache database
+    '''
+
+    def __init__(self, cache_name: str):
+        self.cache_name = cache_name
+        self._cache = SQLiteCache(cache_name)
+        self._index = CacheIndex(cache_name)
+
+    def scan(self) -> Tuple[List[CacheEntry], List[str]]:
+        '''
+        Returns metadata for all readable cached responses (oldest first, entries without
+        creation time last), and the keys of responses that couldn't be deserialized
+        '''
+
+        # requests_cache replaces rows when writing responses, which assigns a new rowid;
+        # comparing rowids catches entries refreshed since the last scan, even by interrupted runs
+        responses = self._cache.responses
+        with responses.connection() as con:
+            rowids = dict(con.execute(f'SELECT key, rowid FROM {responses.table_name}'))
+        keys = set(rowids)
+        self._index.retain(keys)
+
+        entries = []
+        unreadable = []
+        for key, rowid in rowids.items():
+            entry = self._index.get(key, rowid)
+            if entry is None:
+                try:
+                    response = self._cache.responses[key]
+                except Exception as e:
+                    # e.g. from a different serializer/requests_cache version
+                    _logger.debug(f'unable to read cache entry {key}: {e}')
+                    unreadable.append(key)
+                    continue
+                entry = CacheEntry(key, response.url, getattr(response, 'created_at', None), len(response.content), rowid)
+                self._index.add(entry)
+            entries.append(entry)
+        self._index.write()
+
+        if unreadable:
+            _logger.warning(f'unable to read {len(unreadable)}/{len(keys)} cache entries')
+        entries.sort(key=lambda e: (e.created_at is None, e.created_at or datetime.min))
+        return entries, unreadable
+
+    def evict(
+        self,
+        max_age: Dict[SourceType, timedelta],
+        max_size: Dict[SourceType, int],
+        drop_superseded_update_lists: bool = False,
+        drop_unreadable: bool = False
+    ) -> int:
+        '''
+        Removes entries older than the maximum age for their source type, and the oldest entries
+        of each source type exceeding the maximum size (in bytes) for that type.
+        Entries without a known creation time are never removed based on their age,
+        entries that can't be read are only removed if `drop_unreadable` is set.
+
+        Returns the number of removed entries
+        '''
+
+        entries, unreadable = self.scan()
+        now = datetime.utcnow()
+        evicted = set(unreadable) if drop_unreadable else set()
+
+        for entry in entries:
+            age = max_age.get(entry.source_type)
+            if age is not None and entry.created_at is not None and now - entry.created_at.replace(tzinfo=None) > age:
+                evicted.add(entry.key)
+
+        if drop_superseded_update_lists:
+            evicted.update(e.key for e in self._get_superseded_update_lists(entries))
+
+        for source_type, limit in max_size.items():
+            remaining = [e for e in entries if e.source_type == source_type and e.key not in evicted]
+            total = sum(e.size for e in remaining)
+            # entries are sorted by age, remove oldest first
+            for entry in remaining:
+                if total <= limit:
+                    break
+                evicted.add(entry.key)
+                total -= entry.size
+
+        if evicted:
+            self._cache.delete(*evicted)
+            self._index.remove(evicted)
+            self._index.write()
+        _logger.info(f'evicted {len(evicted)}/{len(entries) + len(unreadable)} cache entries')
+        return len(evicted)
+
+    def compact(self) -> None:
+        '''
+        Rebuilds the database file, releasing space of removed entries
+        '''
+
+        size_before = Path(self._cache.db_path).stat().st_size
+        self._cache.responses.vacuum()
+        size_after = Path(self._cache.db_path).stat().st_size
+        _logger.info(f'compacted cache from {size_before} to {size_after} bytes')
+
+    def stats(self, request_stats: Optional[RequestStats] = None) -> str:
+        '''
+        Returns a table of entry counts, sizes and hit rates per host
+        '''
+
+        entries, unreadable = self.scan()
+        counts: Dict[str, Tuple[int, int]] = collections.defaultdict(lambda: (0, 0))
+        for entry in entries:
+            num, size = counts[entry.host]
+            counts[entry.host] = (num + 1, size + entry.size)
+        hits = request_stats.read() if request_stats is not None else {}
+
+        lines = [f'{"host":<40} {"type":<8} {"entries":>8} {"bytes":>12} {"hit rate":>9}']
+        for host in sorted(set(counts) | set(hits)):
+            num, size = counts[host]
+            host_hits = hits.get(host, {})
+            total = host_hits.get('hits', 0) + host_hits.get('misses', 0)
+            hit_rate = f'{host_hits.get("hits", 0) / total:.1%}' if total else '-'
+            lines.append(f'{host or "?":<40} {SourceType.from_host(host).name.lower():<8} {num:>8} {size:>12} {hit_rate:>9}')
+        if unreadable:
+            lines.append(f'{"(unreadable)":<40} {"":<8} {len(unreadable):>8}')
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        self._cache.close()
+
+    def _get_superseded_update_lists(self, entries: Iterable[CacheEntry]) -> List[CacheEntry]:
+        '''
+        Returns all update list entries except for the most recent list version,
+        which older lists are superseded by once they've been processed
+        '''
+
+        lists = []
+        for entry in entries:
+            if entry.source_type != SourceType.TAGAYA:
+                continue
+            match = _updatelist_version_re.search(urlparse(entry.url).path)
+            if match:
+                lists.append((int(match.group(1)), entry))
+
+        if not lists:
+            return []
+        latest = max(version for version, _ in lists)
+        return [entry for version, entry in lists if version < latest]
+
+
+def _parse_policy(values: List[str], convert: Callable[[str], Any]) -> Dict[SourceType, Any]:
+    '''
+    Parses a list of `type=value` strings
+    '''
+
+    policy = {}
+    for value in values:
+        name, _, amount = value.partition('=')
+        try:
+            policy[SourceType[name.upper()]] = convert(amount)
+        except (KeyError, ValueError):
+            raise argparse.ArgumentTypeError(f'invalid policy value: {value}')
+    return policy
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='wiiu_database_updater.cache',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    type_names = ', '.join(t.name.lower() for t in SourceType)
+
+    parser.add_argument(
+        '-l', '--log-level',
+        default='INFO',
+        help='logging level (valid values are python\'s builtin logging levels)'
+    )
+    parser.add_argument(
+        '--cache-file',
+        default=ReqCliConfiguration.cache_name,
+        help='request database cache path'
+    )
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser(
+        'stats',
+        help='show entries, bytes and hit rates per host'
+    )
+    evict_parser = subparsers.add_parser(
+        'evict',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help='remove old/superfluous entries'
+    )
+    evict_parser.add_argument(
+        '--max-age',
+        nargs='*',
+        metavar='TYPE=DAYS',
+        default=['samurai=7'],
+        help=f'maximum age of entries per source type ({type_names})'
+    )
+    evict_parser.add_argument(
+        '--max-size',
+        nargs='*',
+        metavar='TYPE=MB',
+        default=[],
+        help=f'maximum total size of entries per source type ({type_names}), oldest entries are removed first'
+    )
+    evict_parser.add_argument(
+        '--keep-superseded-update-lists',
+        dest='drop_superseded_update_lists',
+        action='store_false',
+        help='keep update lists older than the most recent cached version'
+    )
+    evict_parser.add_argument(
+        '--drop-unreadable',
+        action='store_true',
+        help='remove entries that can\'t be read (e.g. written by a different requests_cache version)'
+    )
+    evict_parser.add_argument(
+        '--no-compact',
+        dest='compact',
+        action='store_false',
+        help='don\'t compact the database after evicting entries'
+    )
+    subparsers.add_parser(
+        'compact',
+        help='compact the database file'
+    )
+    subparsers.add_parser(
+        'reset-stats',
+        help='reset stored hit/miss counts'
+    )
+
+    args = parser.parse_args()
+    if args.command == 'evict':
+        try:
+            args.max_age = _parse_policy(args.max_age, lambda s: timedelta(days=float(s)))
+            args.max_size = _parse_policy(args.max_size, lambda s: int(float(s) * 1024 * 1024))
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+
+    logging.basicConfig(format='%(asctime)s: [%(levelname)s] %(name)s: %(message)s')
+    logging.getLogger('wiiu_database_updater').setLevel(getattr(logging, args.log_level.upper()))
+
+    request_stats = RequestStats(args.cache_file)
+    if args.command == 'reset-stats':
+        request_stats.clear()
+        return
+
+    maintainer = CacheMaintainer(args.cache_file)
+    try:
+        if args.command == 'stats':
+            print(maintainer.stats(request_stats))
+        elif args.command == 'evict':
+            maintainer.evict(args.max_age, args.max_size, args.drop_superseded_update_lists, args.drop_unreadable)
+            if args.compact:
+                maintainer.compact()
+        elif args.command == 'compact':
+            maintainer.compact()
+    finally:
+        maintainer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -135,6 +135,14 @@ class Database:
                 matching_titles[title_all] = None
                 continue
 
+    def contains_title_id(self, title: Title) -> bool:
+        '''
+        Checks whether a title with the same ID (+ version) as the specified title exists,
+        regardless of its region
+        '''
+
+        return TitleNoRegionWrap(title) in self._titles_noregion[title.json_type]
+
     def __contains__(self, title):
         if not isinstance(title, Title):
             return False
@@ -1,6 +1,7 @@
 import logging
 import itertools
-from typing import List, Optional
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, TypeVar
 
 from nus_tools import ids
 from nus_tools.sources import \
@@ -12,9 +13,15 @@ from reqcli.errors import ResponseStatusError
 from reqcli.source import SourceConfig
 
 from .title import Title
+from .scheduler import ProbePriority, ProbeBudget, schedule
 from .database import Database, DatabaseJsonType
+from .cache import RequestStats
+from .verify import TMDVerifier
+from .pool import ConnectionPool
 
 
+TSource = TypeVar('TSource')
+
 _logger = logging.getLogger(__name__)
 
 
@@ -23,11 +30,31 @@ class EShop:
     Used for retrieving different types of :class:`Title` object from eShop data
     '''
 
-    def __init__(self, db: Database, client_cert: CertType, reload: bool, source_config: Optional[SourceConfig] = None):
+    def __init__(
+        self,
+        db: Database,
+        client_cert: CertType,
+        reload: bool,
+        source_config: Optional[SourceConfig] = None,
+        request_stats: Optional[RequestStats] = None,
+        verifier: Optional[TMDVerifier] = None,
+        pool: Optional[ConnectionPool] = None
+    ):
         self._db = db
         self._client_cert = client_cert
         self._reload = reload
         self._source_config = source_config
+        self._request_stats = request_stats
+        self._verifier = verifier
+        self._pool = pool
+        # sources are reused across phases/calls, see `_get_source`
+        self._sources: Dict[Tuple[Any, ...], Any] = {}
+        # titles (and their calculated size) waiting for TMD verification, see `_add_sized_title`
+        self._pending_titles: Dict[Title, Tuple[int, bool, 'Future[Optional[str]]']] = {}
+        # title IDs of games added during this run, and games that samurai indicated having dlcs;
+        # used for prioritizing dlc probes
+        self._new_title_ids: Set[ids.TitleID] = set()
+        self._dlc_hint_title_ids: Set[ids.TitleID] = set()
 
     def get_titles(self, region: Region, shop_id: int) -> None:
         '''
@@ -39,9 +66,9 @@ class EShop:
         _logger.info(f'retrieving titles for region {region}, shop ID {shop_id}')
 
         # shop_id=1 for 3DS, shop_id=2 for WiiU
-        samurai = Samurai(region, shop_id, None, self._source_config)
-        ninja = Ninja(region, self._client_cert, self._source_config)
-        idbe = IDBEServer('wup', self._source_config)  # platform does not matter
+        samurai = self._get_source(Samurai, region, shop_id, None)
+        ninja = self._get_source(Ninja, region, self._client_cert)
+        idbe = self._get_source(IDBEServer, 'wup')  # platform does not matter
 
         num_titles = samurai.get_title_count(skip_cache_read=self._reload)
         title_iterable = itertools.chain.from_iterable(lst.titles for lst in samurai.get_all_title_lists(skip_cache_read=self._reload))
@@ -69,9 +96,14 @@ class EShop:
                 # default to eshop region if IDBE doesn't exist
                 title_regions = [region]
 
+            # samurai's dlc flag isn't always accurate (see `get_wiiu_dlcs`),
+            # which is why this is just used as a hint
+            if title.aoc_available:
+                self._dlc_hint_title_ids.add(ec_info.title_id)
+
             # add title for each region
             for title_region in title_regions:
-                self._db.add_title(Title(
+                new_title = Title(
                     ec_info.title_id,
                     str(title.content_id),
                     title.icon_url or '',
@@ -83,7 +115,11 @@ class EShop:
                     False,
                     None,
                     ec_info.content_size == 0
-                ))
+                )
+                # titles may already exist with a different (e.g. merged) region
+                if not self._db.contains_title_id(new_title):
+                    self._new_title_ids.add(new_title.title_id)
+                self._db.add_title(new_title)
 
     def get_wiiu_updates(self, start_list_version: int = 1) -> int:
         '''
@@ -93,12 +129,12 @@ class EShop:
 
         _logger.info('retrieving updates')
 
-        tagaya_direct = TagayaNoCDN(self._source_config)
+        tagaya_direct = self._get_source(TagayaNoCDN)
         latest_list_version = tagaya_direct.get_latest_updatelist_version().latest
         _logger.debug(f'latest updatelist version: {latest_list_version}; starting from {start_list_version}')
 
-        ccs = ContentServerCDN(self._source_config)
-        tagaya_cdn = TagayaCDN(self._source_config)
+        ccs = self._get_source(ContentServerCDN)
+        tagaya_cdn = self._get_source(TagayaCDN)
         for list_version in range(start_list_version, latest_list_version + 1):
             _logger.info(f'retrieving updatelist version {list_version}/{latest_list_version}')
             try:
@@ -123,27 +159,35 @@ class EShop:
                     version=update_version
                 )
                 # no need to calculate sizes for titles already present in db
-                if update_title not in self._db:
+                if update_title not in self._db and update_title not in self._pending_titles:
                     _logger.info(f'calculating size of update {update_id} v{update_version}')
-                    self._add_size(ccs, update_title, False)
-                    self._db.add_title(update_title)
+                    size = self._get_size(ccs, update_title, False)
+                    self._add_sized_title(ccs, update_title, size, True)
 
+        self._add_verified_titles()
         return latest_list_version
 
-    def get_wiiu_dlcs(self) -> None:
+    def get_wiiu_dlcs(self, time_budget: Optional[float] = None, max_titles: Optional[int] = None) -> None:
         '''
         Retrieves DLCs for titles in the database by checking for the existence of
         their respective TMDs, adding them to the database if they didn't exist
         previously or updating existing database entries
+
+        Titles are checked in order of expected value (see :meth:`_get_dlc_probe_priority`),
+        stopping once the specified time budget (in seconds) or number of checked titles is exhausted
         '''
 
         _logger.info('retrieving dlcs')
 
-        ccs = ContentServerCDN(self._source_config)
+        ccs = self._get_source(ContentServerCDN)
 
         # only check WiiU games
         wiiu_games = [t for t in self._db._titles[DatabaseJsonType.GAMES] if t.title_id.type == ids.TitleType.GAME_WIIU]
-        for i, title in enumerate(wiiu_games):
+        # within each priority, check newer titles first, using descending title IDs as a proxy for age
+        # (this also applies to runs that don't retrieve titles, where only known dlcs are prioritized)
+        wiiu_games.sort(key=lambda t: str(t.title_id), reverse=True)
+        budget = ProbeBudget(time_budget, max_titles)
+        for i, title in enumerate(schedule(wiiu_games, self._get_dlc_probe_priority, budget)):
             _logger.info(f'checking if title {title.title_id} has dlc ({i + 1}/{len(wiiu_games)})')
 
             # some comments:
@@ -163,12 +207,13 @@ class EShop:
                     # if dlc already exists, just try to update the size of the existing dlc
                     # TODO: (this next line is pretty inefficient)
                     dlc_title = next(t for t in self._db._titles[DatabaseJsonType.DLCS] if t == dlc_title)
-                    self._add_size(ccs, dlc_title, self._reload)
+                    size = self._get_size(ccs, dlc_title, self._reload)
+                    self._add_sized_title(ccs, dlc_title, size, False)
                     _logger.info('found known dlc, recalculated size')
                 else:
                     # if dlc doesn't exist, get size and add title to db
-                    self._add_size(ccs, dlc_title, self._reload)
-                    self._db.add_title(dlc_title, overwrite=True)
+                    size = self._get_size(ccs, dlc_title, self._reload)
+                    self._add_sized_title(ccs, dlc_title, size, True)
                     _logger.info('found new dlc, calculated size')
             except ResponseStatusError as e:
                 # if a 404 is returned, there is no DLC
@@ -177,6 +222,41 @@ class EShop:
                     continue
                 raise
 
+        self._add_verified_titles()
+
+    def _get_source(self, cls: Type[TSource], *args: Any) -> TSource:
+        '''
+        Returns the source of the specified type created with the given arguments (+ source config),
+        creating it first if it doesn't exist yet.
+        New sources are set up to use the shared connection pool and request tracking, if enabled
+        '''
+
+        key = (cls, *args)
+        if key not in self._sources:
+            source = cls(*args, self._source_config)  # type: ignore
+            if self._pool is not None:
+                self._pool.attach(source)
+            if self._request_stats is not None:
+                self._request_stats.install(source)
+            if self._verifier is not None and cls is ContentServerCDN:
+                self._verifier.install(source)  # type: ignore
+            self._sources[key] = source
+        return self._sources[key]
+
+    def _get_dlc_probe_priority(self, title: Title) -> ProbePriority:
+        '''
+        Returns the dlc probe priority of the specified game, preferring
+        known dlcs, games added in this run and games hinted at by samurai
+        '''
+
+        if Title(title_id=title.title_id.dlc) in self._db:
+            return ProbePriority.KNOWN
+        if title.title_id in self._new_title_ids:
+            return ProbePriority.RECENT
+        if title.title_id in self._dlc_hint_title_ids:
+            return ProbePriority.HINTED
+        return ProbePriority.OTHER
+
     def _get_regions(self, idbe: IDBEServer, title_id: ids.TTitleIDInput) -> List[Region]:
         '''
         Computes the regions for the specified title ID using its associated IDBE file
@@ -208,17 +288,51 @@ class EShop:
                 raise RuntimeError(f'no known region found for title ID {title_id}')
             return regions
 
-    def _add_size(self, ccs: ContentServerCDN, title: Title, skip_cache_read: bool) -> None:
+    def _get_size(self, ccs: ContentServerCDN, title: Title, skip_cache_read: bool) -> int:
         '''
-        Calculates the size of the specified title using its TMD and adds the size to that title
+        Calculates the size of the specified title using its TMD
         '''
 
         # get TMD for title (+ version)
         version = title.version if title.title_id.is_update else None
+        if self._verifier is not None:
+            self._verifier.begin_capture()
         tmd = ccs.get_tmd(title.title_id, version, skip_cache_read=skip_cache_read).data
         # sanity check
         if version is not None:
             assert tmd.title_version == version
 
         # calculate size based on contents
-        title.size = sum(c.size for c in tmd.contents)
+        return sum(c.size for c in tmd.contents)
+
+    def _add_sized_title(self, ccs: ContentServerCDN, title: Title, size: int, add: bool) -> None:
+        '''
+        Sets the size of the specified title, adding it to the database if `add` is set.
+        Must be called directly after :meth:`_get_size` for the same title.
+
+        If TMD verification is enabled, this is deferred until :meth:`_add_verified_titles`
+        is called, and titles that fail verification are neither updated nor added
+        '''
+
+        if self._verifier is None:
+            title.size = size
+            if add:
+                self._db.add_title(title, overwrite=True)
+        else:
+            self._pending_titles[title] = (size, add, self._verifier.submit(ccs, title))
+
+    def _add_verified_titles(self) -> None:
+        '''
+        Waits for pending TMD verifications, adding titles that passed verification to the database
+        '''
+
+        if self._verifier is None:
+            return
+
+        for title, (size, add, future) in self._pending_titles.items():
+            if not self._verifier.check(title, future):
+                continue
+            title.size = size
+            if add:
+                self._db.add_title(title, overwrite=True)
+        self._pending_titles.clear()
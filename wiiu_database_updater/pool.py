@@ -0,0 +1,139 @@
+import logging
+import collections
+from typing import Any, Counter, List, Optional, Type
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+_logger = logging.getLogger(__name__)
+
+
+def get_source_session(source: Any) -> Optional[requests.Session]:
+    '''
+    Returns the underlying session of the specified source, if it has one
+    '''
+
+    session = getattr(source, '_session', None)
+    if not isinstance(session, requests.Session):
+        return None
+    return session
+
+
+class ConnectionPool:
+    '''
+    Keep-alive connection pool shared between multiple sources, avoiding repeated
+    TCP/TLS handshakes for hosts used by more than one source (or in more than one phase)
+
+    Args:
+        pool_connections (int): Number of per-host pools to keep
+        pool_maxsize (int): Maximum number of connections kept per host
+    '''
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10):
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        # whether the adapter configuration (i.e. retries) was copied from a source's adapter yet
+        self._configured = False
+        # number of (re)connects per host, i.e. handshakes
+        self._connects: Counter[str] = collections.Counter()
+        # number of requests of pools that were discarded after exceeding `pool_connections`
+        self._discarded_requests: Counter[str] = collections.Counter()
+        # sources/prefixes that don't use this pool
+        self._unpooled: List[str] = []
+
+        poolmanager = self._adapter.poolmanager
+        poolmanager.pool_classes_by_scheme = {
+            'http': self._create_counting_pool_class(HTTPConnectionPool),
+            'https': self._create_counting_pool_class(HTTPSConnectionPool)
+        }
+
+        pools = poolmanager.pools
+        dispose_func = pools.dispose_func
+
+        def dispose_and_record(pool: Any) -> None:
+            self._discarded_requests[pool.host] += pool.num_requests
+            if dispose_func is not None:
+                dispose_func(pool)
+        pools.dispose_func = dispose_and_record
+
+    def attach(self, source: Any) -> None:
+        '''
+        Makes the specified source use this pool for all requests, replacing
+        every plain :class:`HTTPAdapter` mounted on its session (for any prefix)
+        '''
+
+        name = type(source).__name__
+        session = get_source_session(source)
+        if session is None:
+            _logger.warning(f'unable to use shared connection pool for {name}, no session found')
+            self._unpooled.append(name)
+            return
+
+        for prefix, adapter in list(session.adapters.items()):
+            if adapter is self._adapter:
+                continue
+            # don't replace subclasses/custom adapters, their additional behavior would be lost
+            if type(adapter) is not HTTPAdapter:
+                _logger.warning(f'{name} uses a custom adapter ({type(adapter).__name__}) for \'{prefix}\', not using shared connection pool')
+                self._unpooled.append(f'{name} ({prefix})')
+                continue
+            self._copy_config(name, adapter)
+            session.mount(prefix, self._adapter)
+
+    def report(self) -> str:
+        '''
+        Returns a summary of requests, new connections (i.e. handshakes) and reused connections per host,
+        and the sources that aren't using this pool
+        '''
+
+        num_requests = collections.Counter(self._discarded_requests)
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            num_requests[pool.host] += pool.num_requests
+
+        lines = ['connection reuse per host:']
+        for host in sorted(set(num_requests) | set(self._connects)):
+            reused = num_requests[host] - self._connects[host]
+            lines.append(f'  {host}: {num_requests[host]} requests, {self._connects[host]} handshakes, {reused} reused connections')
+        if self._unpooled:
+            lines.append(f'not using shared connection pool: {", ".join(self._unpooled)}')
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        self._adapter.close()
+
+    def _copy_config(self, name: str, adapter: HTTPAdapter) -> None:
+        '''
+        Uses the retry configuration of the specified adapter for the shared adapter,
+        warning if it differs from the configuration of previously attached sources
+        '''
+
+        if not self._configured:
+            self._adapter.max_retries = adapter.max_retries
+            self._configured = True
+        elif repr(adapter.max_retries) != repr(self._adapter.max_retries):
+            _logger.warning(
+                f'retry configuration of {name} ({adapter.max_retries!r}) differs from shared '
+                f'connection pool ({self._adapter.max_retries!r}), using the latter'
+            )
+
+    def _create_counting_pool_class(self, pool_cls: Type[HTTPConnectionPool]) -> Type[HTTPConnectionPool]:
+        '''
+        Creates a subclass of the specified connection pool class, counting every connect of its connections.
+        urllib3 reuses connection objects after the underlying socket was closed, which is why
+        the pools' `num_connections` doesn't include reconnects
+        '''
+
+        connects = self._connects
+
+        class CountingConnection(pool_cls.ConnectionCls):  # type: ignore
+            def connect(self) -> None:
+                connects[self.host] += 1
+                super().connect()
+
+        class CountingConnectionPool(pool_cls):  # type: ignore
+            ConnectionCls = CountingConnection
+
+        return CountingConnectionPool
@@ -0,0 +1,75 @@
+import time
+import logging
+from enum import IntEnum
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+
+T = TypeVar('T')
+
+_logger = logging.getLogger(__name__)
+
+
+class ProbePriority(IntEnum):
+    '''
+    Expected value of a probe, lower values are probed first
+    '''
+
+    KNOWN = 0
+    RECENT = 1
+    HINTED = 2
+    OTHER = 3
+
+
+class ProbeBudget:
+    '''
+    Limits the number of probes and/or the time spent probing
+
+    Args:
+        time_budget (Optional[float]): Maximum number of seconds to spend, starting with the first probe
+        max_probes (Optional[int]): Maximum number of probes
+    '''
+
+    def __init__(self, time_budget: Optional[float] = None, max_probes: Optional[int] = None):
+        self.time_budget = time_budget
+        self.max_probes = max_probes
+        self.probes = 0
+        self._start: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self._start is None:
+            return 0.0
+        return time.monotonic() - self._start
+
+    def exhausted(self) -> bool:
+        if self.max_probes is not None and self.probes >= self.max_probes:
+            return True
+        if self.time_budget is not None and self.elapsed >= self.time_budget:
+            return True
+        return False
+
+    def consume(self) -> None:
+        if self._start is None:
+            self._start = time.monotonic()
+        self.probes += 1
+
+
+def schedule(items: Iterable[T], priority: Callable[[T], ProbePriority], budget: ProbeBudget) -> Iterator[T]:
+    '''
+    Yields the given items ordered by priority (keeping the original order for items with
+    the same priority), stopping once the budget is exhausted.
+
+    The budget is checked lazily before every item, so time spent by the caller
+    processing previous items counts towards the time budget
+    '''
+
+    ordered = sorted(items, key=priority)  # sorted() is stable
+    for i, item in enumerate(ordered):
+        if budget.exhausted():
+            _logger.info(
+                f'probe budget exhausted after {budget.probes} probes ({budget.elapsed:.1f}s), '
+                f'skipping {len(ordered) - i} remaining probes'
+            )
+            return
+        budget.consume()
+        yield item
@@ -0,0 +1,136 @@
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, List, Optional, Tuple
+
+import construct
+import requests
+from nus_tools.config import Configuration as NUSToolsConfiguration
+from nus_tools.structs import tmd as tmd_struct
+from nus_tools.sources import ContentServerCDN
+
+from .title import Title
+from .pool import get_source_session
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _init_worker(root_key: Any) -> None:
+    NUSToolsConfiguration.root_key_struct = root_key
+
+
+def _verify_tmd(data: bytes) -> Optional[str]:
+    '''
+    Parses the specified TMD data with signature verification enabled.
+
+    Returns an error message if verification failed, `None` otherwise
+    '''
+
+    try:
+        tmd_struct.parse(data)
+    except construct.ConstructError as e:
+        # raised by nus_tools' TMD struct for invalid signatures (and malformed data)
+        return f'{type(e).__name__}: {e}'
+    return None
+
+
+class TMDVerifier:
+    '''
+    Verifies TMD signatures in a pool of worker processes, allowing signature verification
+    to run in parallel with network requests in the main process.
+
+    The raw TMD data is captured from the responses received by the sources passed
+    to :meth:`install`, and sent to the worker processes for parsing
+
+    Args:
+        root_key (Any): Parsed 'Root' public key (signing CA for TMD/Ticket files)
+        processes (Optional[int]): Number of worker processes. Defaults to the number of CPUs
+    '''
+
+    def __init__(self, root_key: Any, processes: Optional[int] = None):
+        self.root_key = root_key
+        self._executor = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(root_key,))
+        self._captured_data: Optional[bytes] = None
+        self.failures: List[Tuple[Title, str]] = []
+        self.num_verified = 0
+
+    def install(self, ccs: ContentServerCDN) -> None:
+        '''
+        Starts capturing the raw data of responses received by the specified source
+        '''
+
+        session = get_source_session(ccs)
+        if session is None:
+            _logger.warning('unable to capture TMD data, TMDs will be verified in the main process')
+            return
+        session.hooks['response'].append(self._capture)
+
+    def begin_capture(self) -> None:
+        '''
+        Resets the captured data, should be called before retrieving a TMD
+        '''
+
+        self._captured_data = None
+
+    def submit(self, ccs: ContentServerCDN, title: Title) -> 'Future[Optional[str]]':
+        '''
+        Schedules verification of the specified title's TMD, using the data captured since
+        the last call to :meth:`begin_capture`.
+
+        If no data was captured (e.g. if the response didn't run through the session's hooks),
+        the TMD is verified in the main process instead
+        '''
+
+        data, self._captured_data = self._captured_data, None
+        if data is not None:
+            return self._executor.submit(_verify_tmd, data)
+
+        future: 'Future[Optional[str]]' = Future()
+        future.set_result(self._verify_in_process(ccs, title))
+        return future
+
+    def check(self, title: Title, future: 'Future[Optional[str]]') -> bool:
+        '''
+        Waits for the result of a verification previously scheduled using :meth:`submit`,
+        recording failures for :meth:`report`
+        '''
+
+        error = future.result()
+        self.num_verified += 1
+        if error is not None:
+            _logger.warning(f'signature verification of TMD for {title.title_id} failed: {error}')
+            self.failures.append((title, error))
+            return False
+        return True
+
+    def report(self) -> str:
+        '''
+        Returns a summary of all verification failures
+        '''
+
+        lines = [f'verified {self.num_verified} TMDs, {len(self.failures)} failed']
+        for title, error in self.failures:
+            version = f' v{title.version}' if title.version is not None else ''
+            lines.append(f'  {title.title_id}{version}: {error}')
+        return '\n'.join(lines)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+    def _capture(self, response: requests.Response, *args: Any, **kwargs: Any) -> None:
+        self._captured_data = response.content
+
+    def _verify_in_process(self, ccs: ContentServerCDN, title: Title) -> Optional[str]:
+        '''
+        Retrieves the specified title's TMD again (usually from the cache), with signature verification enabled
+        '''
+
+        version = title.version if title.title_id.is_update else None
+        NUSToolsConfiguration.root_key_struct = self.root_key
+        try:
+            ccs.get_tmd(title.title_id, version)
+        except construct.ConstructError as e:
+            return f'{type(e).__name__}: {e}'
+        finally:
+            NUSToolsConfiguration.root_key_struct = None
+        return None